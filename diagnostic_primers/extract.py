@@ -47,8 +47,13 @@ import statistics
 
 from collections import defaultdict, namedtuple
 
+import numpy as np
+
 from Bio import SeqIO
-from Bio.Phylo.TreeConstruction import DistanceCalculator
+from Bio.Align import PairwiseAligner, substitution_matrices
+from Bio.Seq import Seq
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqRecord import SeqRecord
 
 from diagnostic_primers.primersearch import parse_output
 
@@ -60,6 +65,10 @@ from diagnostic_primers.primersearch import parse_output
 # seq: Bio.Seq.Seq object
 PSResultAmplimer = namedtuple("PSResultAmplimer", "psresult primer amplimer seq")
 
+# Approximate memory limit (bytes) for intermediate arrays when counting
+# pairwise mismatches between aligned sequences
+MISMATCH_BLOCK_BYTES = 2**26
+
 # Convenience struct for returning distance calculations
 DistanceResults = namedtuple(
     "DistanceResults",
@@ -158,12 +167,14 @@ class PDPAmpliconCollection:
 
         :param pname:       Primer for which to write amplicons
         :param fname:             Path to write FASTA file
+
+        Returns the number of sequences written
         """
         with open(fname, "w") as ofh:
             seqdata = self.get_primer_amplicon_sequences(pname)
             # Order sequence data for consistent output (aids testing)
             seqdata = [_[1] for _ in sorted([(seq.id, seq) for seq in seqdata])]
-            SeqIO.write(seqdata, ofh, "fasta")
+            return SeqIO.write(seqdata, ofh, "fasta")
 
     def __iter__(self):
         """Iterate over amplicons in the collection"""
@@ -351,31 +362,133 @@ def add_amplicons(eadata, target, psresult, caches):
             )
 
 
+def align_amplicon_pair(infname, outfname):
+    """Globally align the two amplicon sequences in a FASTA file
+
+    :param infname:  path to FASTA file containing exactly two sequences
+    :param outfname:  path to write FASTA format alignment
+
+    This avoids launching MAFFT for the trivial two-sequence case. Scoring
+    follows EMBOSS needle defaults (NUC.4.4, gap open -10, gap extend -0.5,
+    no end gap penalty), and the alignment is written in lower case, as MAFFT
+    does.
+    """
+    with open(infname, "r") as ifh:
+        records = list(SimpleFastaParser(ifh))
+    if len(records) != 2:
+        raise PDPAmpliconError(
+            "Expected two sequences in %s, found %d" % (infname, len(records))
+        )
+    aligner = PairwiseAligner()
+    aligner.substitution_matrix = substitution_matrices.load("NUC.4.4")
+    aligner.open_gap_score = -10
+    aligner.extend_gap_score = -0.5
+    aligner.end_gap_score = 0
+    alignment = aligner.align(records[0][1].upper(), records[1][1].upper())[0]
+    SeqIO.write(
+        [
+            SeqRecord(
+                Seq(alignment[idx].lower()), id=title.split()[0], description=title
+            )
+            for idx, (title, _) in enumerate(records)
+        ],
+        outfname,
+        "fasta",
+    )
+
+
+def load_alignment_array(fname):
+    """Return the sequences of a FASTA alignment as a 2D uint8 array
+
+    :param fname:  path to FASTA format alignment
+
+    Each row of the returned array holds the ASCII bytes of one aligned
+    sequence, in file order. Raises PDPAmpliconError if the file contains no
+    sequences, or if the sequences are not all the same length.
+    """
+    with open(fname, "r") as ifh:
+        rows = [
+            np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+            for _, seq in SimpleFastaParser(ifh)
+        ]
+    if not rows:
+        raise PDPAmpliconError("Alignment %s contains no sequences" % fname)
+    try:
+        return np.vstack(rows)
+    except ValueError:
+        raise PDPAmpliconError(
+            "Sequences in alignment %s are not all the same length" % fname
+        )
+
+
+def alignment_array(aln):
+    """Return the passed alignment as a 2D uint8 array
+
+    - aln           2D uint8 array, or Bio.AlignIO.MultipleSeqAlignment
+
+    Arrays are returned unchanged; other alignments are converted to one row of
+    ASCII bytes per sequence, as produced by load_alignment_array.
+    """
+    if isinstance(aln, np.ndarray):
+        return aln
+    rows = [np.frombuffer(str(_.seq).encode("ascii"), dtype=np.uint8) for _ in aln]
+    try:
+        return np.vstack(rows)
+    except ValueError:
+        raise PDPAmpliconError("Alignment contains no sequences")
+
+
+def count_mismatches(aln):
+    """Return square matrix of mismatched column counts between sequences
+
+    - aln           2D uint8 array of aligned sequences
+
+    Comparisons are vectorised over blocks of rows, with block size chosen to
+    keep the intermediate boolean array to about MISMATCH_BLOCK_BYTES.
+    """
+    nseqs, alnlen = aln.shape
+    mismatches = np.empty((nseqs, nseqs), dtype=np.int32)
+    blocksize = max(1, MISMATCH_BLOCK_BYTES // max(1, nseqs * alnlen))
+    for start in range(0, nseqs, blocksize):
+        block = aln[start : start + blocksize]
+        mismatches[start : start + blocksize] = np.not_equal(
+            block[:, None, :], aln[None, :, :]
+        ).sum(axis=-1, dtype=np.int32)
+    return mismatches
+
+
 def calculate_distance(aln, calculator="identity"):
-    """Report distance measures for the passed nucleotide AlignIO object
+    """Report distance measures for the passed nucleotide alignment
 
-    - aln           A Bio.AlignIO.MultipleSeqAlignment
+    - aln           2D uint8 array of aligned sequences (see load_alignment_array)
+                    or a Bio.AlignIO.MultipleSeqAlignment
     - calculator    The metric to use when calculating distance
 
-    If the alignment contains only a single sequence, return zeroes for all fields,
-    and a None for the distance matrix
+    Distances are identity distances: the proportion of alignment columns at
+    which two sequences differ. If the alignment contains only a single
+    sequence, PDPAmpliconError is raised.
     """
-    if len(aln) == 1:  # We can't calculate distances or a matrix
+    aln = alignment_array(aln)
+    nseqs, alnlen = aln.shape
+    if nseqs == 1:  # We can't calculate distances or a matrix
         raise PDPAmpliconError(
             "Alignment contains a single sequence: cannot calculate distances"
         )
-    calculator = DistanceCalculator("identity")
-    distmat = calculator.get_distance(aln)
-    # Flatten the DistanceMatrix's matrix, discarding the diagonal
-    # The DistanceMatrix is a lower-triangular matrix, so the last item
-    # in each row is on the diagonal
-    # This gives a list of all pairwise distances
-    distances = [_ for sublist in distmat.matrix for _ in sublist[:-1]]
-    # The number of unique amplicons is found by taking the length
-    # of the set comprehension of sequences in the alignment
-    unique = len({str(_.seq) for _ in aln})
-    nonunique = len(aln) - unique
-    shannon, evenness = shannon_index(aln)
+    mismatches = count_mismatches(aln)
+    if alnlen:
+        distmat = mismatches / alnlen
+    else:  # empty sequences are maximally distant
+        distmat = np.ones((nseqs, nseqs)) - np.eye(nseqs)
+    # Flatten the lower triangle of the symmetric distance matrix, discarding
+    # the diagonal. This gives a list of all pairwise distances
+    distances = distmat[np.tril_indices(nseqs, -1)].tolist()
+    # The number of unique amplicons is the number of distinct rows in the
+    # alignment. Finding them sorts every row, so the row counts are found
+    # once, and also used for the Shannon index
+    _, counts = np.unique(aln, axis=0, return_counts=True)
+    unique = len(counts)
+    nonunique = nseqs - unique
+    shannon, evenness = shannon_from_counts(counts)
     # The standard deviation calculation throws an error if there's only one
     # distance, which occurs when there are only two sequences in the
     # alignment
@@ -383,7 +496,7 @@ def calculate_distance(aln, calculator="identity"):
         distmat,
         distances,
         statistics.mean(distances),
-        statistics.stdev(distances) if len(aln) > 2 else 0,
+        statistics.stdev(distances) if nseqs > 2 else 0,
         min(distances),
         max(distances),
         unique,
@@ -396,7 +509,8 @@ def calculate_distance(aln, calculator="identity"):
 def shannon_index(aln):
     """Returns the Shannon index and evenness of a sequence alignment
 
-    aln         A Bio.AlignIO.MultipleSeqAlignment
+    aln         2D uint8 array of aligned sequences (see load_alignment_array)
+                or a Bio.AlignIO.MultipleSeqAlignment
 
     Shannon index is a measure of the sequence diversity of an alignment. It accounts
     for abundance and evenness of the number of unique sequences present.
@@ -415,21 +529,32 @@ def shannon_index(aln):
 
     E_H is constrained between 1 (completely even) and 0 (uneven distribution).
     """
-    # Make dictionary of unique sequence counts
-    countdict = defaultdict(int)
-    alnsize = len(aln)
-    for seq in aln:
-        countdict[hash(str(seq.seq))] += 1
+    # Count occurrences of each unique sequence
+    _, counts = np.unique(alignment_array(aln), axis=0, return_counts=True)
+    return shannon_from_counts(counts)
+
+
+def shannon_from_counts(counts):
+    """Returns the Shannon index and evenness for counts of distinct sequences
+
+    counts      sequence of the number of occurrences of each distinct sequence
+
+    See shannon_index() for the definitions used.
+    """
+    # Use Python ints, so that a single distinct sequence gives evenness zero
+    # (ZeroDivisionError), rather than NumPy's NaN
+    counts = [int(_) for _ in counts]
+    alnsize = sum(counts)
 
     # Calculate Shannon index
     sindex = 0
-    for _, count in countdict.items():
+    for count in counts:
         p_i = count / alnsize
         sindex -= p_i * math.log(p_i)
 
     # Calculate evenness
     try:
-        seven = sindex / math.log(len(countdict))
+        seven = sindex / math.log(len(counts))
     except ZeroDivisionError:
         seven = 0
 
@@ -46,10 +46,11 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import multiprocessing
 import subprocess
 import sys
 
+from multiprocessing.pool import ThreadPool
+
 CUMRETVAL = 0
 
 
@@ -126,7 +127,10 @@ def run(cmdlines, workers=None):
     # of processes in a Manager.
     # The command-lines in this package may be provided as any object whose
     # __str__() attribute returns the command-line as a string.
-    pool = multiprocessing.Pool(processes=workers)
+    # Each task only waits on its own subprocess, so a pool of threads is
+    # sufficient. This also avoids forking the calling process, which may
+    # be running threads of its own (e.g. a joblib executor feeding cmdlines).
+    pool = ThreadPool(processes=workers)
     results = [
         pool.apply_async(
             subprocess.run,
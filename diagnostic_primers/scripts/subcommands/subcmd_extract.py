@@ -41,16 +41,18 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import multiprocessing
+import functools
+import itertools
+import logging
 import os
+import shlex
 import shutil
+import tempfile
 
-from Bio import AlignIO, SeqIO
-from joblib import Parallel, delayed
 from tqdm import tqdm
 
-from diagnostic_primers import extract, load_primers
-from diagnostic_primers.extract import PDPAmpliconError
+from diagnostic_primers import load_primers, sge
+from diagnostic_primers.sge_jobs import JobGroup
 from diagnostic_primers.scripts.tools import (
     collect_existing_output,
     create_output_directory,
@@ -59,29 +61,95 @@ from diagnostic_primers.scripts.tools import (
     run_parallel_jobs,
 )
 
+# NOTE: joblib and diagnostic_primers.extract are imported inside the
+# functions that use them, so that they are only loaded when the extract
+# subcommand actually runs, not whenever the pdp script starts.
 
-def extract_primers(task_name, primer, coll, outdir, limits):
+# Number of distance summary rows to buffer between writes
+TSV_BATCH_SIZE = 1024
+
+# Number of CPUs available for parallel tasks
+CPU_COUNT = os.cpu_count() or 1
+
+
+@functools.lru_cache(maxsize=1)
+def load_shared_collection(collpath):
+    """Return PDPCollection saved with joblib.dump, loading once per process
+
+    :param collpath:  path to the saved PDPCollection
+    """
+    from joblib import load
+
+    return load(collpath)
+
+
+def extraction_worker_count(coll, ntasks, cpus=CPU_COUNT):
+    """Return the number of amplicon extraction workers to run in parallel
+
+    :param coll:  PDPCollection describing genomes for the run
+    :param ntasks:  number of extraction tasks (primers)
+    :param cpus:  number of CPUs available for extraction
+
+    Each worker may cache every genome sequence in the collection, so we
+    budget twice the total size of the sequence files per worker, and run no
+    more workers than fit in the currently available memory. The count is
+    also capped at the number of CPUs and tasks, and is at least one.
+    """
+    import psutil
+
+    per_worker = max(1, 2 * sum(os.path.getsize(_.seqfile) for _ in coll.data))
+    return max(1, min(cpus, ntasks, psutil.virtual_memory().available // per_worker))
+
+
+def extract_primers(task_name, primer, collpath, outdir, limits):
     """Convenience function for parallelising primer extraction
 
     :param task_name:
     :param primer:
-    :param coll:
+    :param collpath:      path to PDPCollection saved with joblib.dump
     :param outdir:
     :param limits:        tuple - minimum and maximum amplicon lengths to consider
 
-    Returns dict of primer identity and FASTA file path
+    Returns list of (primer identity, FASTA file path, sequence count) tuples
     """
+    from diagnostic_primers import extract
+
+    coll = load_shared_collection(collpath)
     amplicons, _ = extract.extract_amplicons(task_name, primer, coll, limits)
 
-    amplicon_fasta = {}
+    amplicon_fasta = []
+    outprefix = os.path.join(outdir, "")  # path with trailing separator
     for pname in amplicons.primer_names:
-        seqoutfname = os.path.join(outdir, pname + ".fasta")
-        amplicons.write_amplicon_sequences(pname, seqoutfname)
-        amplicon_fasta[pname] = seqoutfname
+        seqoutfname = outprefix + pname + ".fasta"
+        nseqs = amplicons.write_amplicon_sequences(pname, seqoutfname)
+        amplicon_fasta.append((pname, seqoutfname, nseqs))
 
     return amplicon_fasta
 
 
+def summarise_alignment(pname, alnfname):
+    """Convenience function for parallelising distance calculations
+
+    :param pname:  name of the primer that produced the amplicons
+    :param alnfname:  path to the amplicon alignment
+
+    Returns a tuple of primer name, DistanceResults, and the PDPAmpliconError
+    raised if distances could not be calculated (otherwise None). In the
+    error case, the DistanceResults values are all zero.
+
+    Only the summary values are returned: the distance matrix and list of
+    pairwise distances are dropped, so that they are not passed back to the
+    parent process and held there for every primer.
+    """
+    from diagnostic_primers import extract
+
+    try:
+        result = extract.calculate_distance(extract.load_alignment_array(alnfname))
+    except extract.PDPAmpliconError as exc:  # Catches alignment/calculation problems
+        return (pname, extract.DistanceResults(None, [], 0, 0, 0, 0, 0, 0, 0, 0), exc)
+    return (pname, result._replace(matrix=None, distances=[]), None)
+
+
 def recover_existing_aln_files(args, logger, outdir):
     """Return list of existing alignment files if in recovery mode
 
@@ -105,52 +173,160 @@ def recover_existing_aln_files(args, logger, outdir):
     return []
 
 
-def mafft_align_sequences(args, logger, amplicon_fasta, outdir):
-    """Align amplicon sequences using MAFFT
+def compile_mafft_commands(args, logger, amplicon_fasta, outdir):
+    """Generate MAFFT alignment commands for amplicon sequences
 
     :param args: Namespace of command-line arguments
     :param logger: logging object
-    :param amplicon_fasta: dictionary of amplicon sequences keyed by filename
+    :param amplicon_fasta: iterable of (primer name, amplicon FASTA path,
+        sequence count) tuples
     :param outdir: path to output directory
+
+    Yields a (primer name, alignment path, command line, pair path) tuple for
+    each amplicon file, as it is read from amplicon_fasta. The command line is
+    None if no MAFFT job needs to be run for the amplicon. The pair path is
+    the amplicon FASTA path if it holds two sequences that should be aligned
+    in-process with align_amplicon_pairs(), and None otherwise.
     """
     # If we are in recovery mode, we are salvaging output from a previous
     # run, and do not necessarily need to rerun all the jobs. In this case,
     # we prepare a list of output files we want to recover from the results
     # in the output directory.
-    amplicon_alnfiles = {}
-    existingfiles = recover_existing_aln_files(args, logger, outdir)
-    clines = []
-    logger.info(
-        "Compiling MAFFT alignment commands for %d amplicons", len(amplicon_fasta)
-    )
-    for pname, fname in tqdm(
-        amplicon_fasta.items(),
-        desc="compiling MAFFT commands",
-        disable=args.disable_tqdm,
+    existingfiles = set(recover_existing_aln_files(args, logger, outdir))
+    outprefix = os.path.join(outdir, "")  # path with trailing separator
+    logger.info("Compiling MAFFT alignment commands")
+    for pname, fname, nseqs in tqdm(
+        amplicon_fasta, desc="compiling MAFFT commands", disable=args.disable_tqdm
     ):
-        alnoutfname = os.path.join(outdir, pname + ".aln")
-        amplicon_alnfiles[pname] = alnoutfname
-        with open(fname, "r") as ifh:
-            if len(list(SeqIO.parse(ifh, "fasta"))) < 2:
-                logger.warning(
-                    "Output amplicon file %s cannot be aligned with MAFFT (copying)",
-                    fname,
-                )
-                shutil.copyfile(fname, alnoutfname)
-        if os.path.split(alnoutfname)[-1] not in existingfiles:  # skip if file exists
-            # MAFFT is run with --quiet flag to suppress verbiage in STDERR
-            clines.append(
-                "pdp_mafft_wrapper.py {} --quiet {} {}".format(
+        alnoutfname = outprefix + pname + ".aln"
+        cline, pairfname = None, None
+        if nseqs < 2:
+            logger.warning(
+                "Output amplicon file %s cannot be aligned with MAFFT (copying)", fname
+            )
+            shutil.copyfile(fname, alnoutfname)
+        if os.path.basename(alnoutfname) not in existingfiles:  # skip if file exists
+            if nseqs == 2:
+                # A pairwise alignment is quicker in-process than launching MAFFT
+                pairfname = fname
+            else:
+                # MAFFT is run with --quiet flag to suppress verbiage in STDERR
+                cline = "pdp_mafft_wrapper.py {} --quiet {} {}".format(
                     args.mafft_exe, fname, alnoutfname
                 )
-            )
+        yield (pname, alnoutfname, cline, pairfname)
+
+
+def align_amplicon_pairs(args, logger, pairfiles):
+    """Align two-sequence amplicon files in-process, in parallel
+
+    :param args: Namespace of command-line arguments
+    :param logger: logging object
+    :param pairfiles: list of (amplicon FASTA path, alignment path) tuples
+
+    At most args.workers (default: all CPUs) alignments run at once, so this
+    should not be called while the local MAFFT pool is running.
+    """
+    if not pairfiles:
+        return
+    from joblib import Parallel, delayed
+
+    from diagnostic_primers import extract
+
+    logger.info("Aligning %d two-sequence amplicon files", len(pairfiles))
+    Parallel(n_jobs=min(args.workers or CPU_COUNT, len(pairfiles)))(
+        delayed(extract.align_amplicon_pair)(fname, alnoutfname)
+        for fname, alnoutfname in pairfiles
+    )
+
+
+def mafft_sge_jobgroups(args, alnfnames):
+    """Return SGE array JobGroups that run MAFFT on amplicon files
+
+    :param args: Namespace of command-line arguments
+    :param alnfnames: paths of the alignments to produce
+
+    Amplicon FASTA and alignment files share a path stem (<stem>.fasta and
+    <stem>.aln), so each array task needs only its stem. Tasks are split into
+    JobGroups of at most args.sgegroupsize, named with args.jobprefix.
+    """
+    command = 'pdp_mafft_wrapper.py {} --quiet "$stem.fasta" "$stem.aln"'.format(
+        shlex.quote(args.mafft_exe)
+    )
+    stems = [shlex.quote(os.path.splitext(_)[0]) for _ in alnfnames]
+    return [
+        JobGroup(
+            "%s_mafft_%d" % (args.jobprefix, idx), command, arguments={"stem": sublist}
+        )
+        for idx, sublist in enumerate(sge.split_seq(stems, args.sgegroupsize), 1)
+    ]
+
+
+def mafft_align_sequences(args, logger, amplicon_fasta, outdir, workers=None):
+    """Align amplicon sequences using MAFFT
+
+    :param args: Namespace of command-line arguments
+    :param logger: logging object
+    :param amplicon_fasta: iterable of (primer name, amplicon FASTA path,
+        sequence count) tuples
+    :param outdir: path to output directory
+    :param workers: number of local MAFFT jobs to run at once, if not
+        args.workers
+
+    Returns list of (primer name, alignment path) tuples
+
+    With the multiprocessing scheduler, each MAFFT job is started as soon as
+    its amplicon file is available from amplicon_fasta, so if that is a lazy
+    iterable, alignment overlaps with extraction of the remaining amplicons.
+    Two-sequence amplicon files are aligned in-process once the local MAFFT
+    jobs are done (or, with SGE, once the MAFFT jobs are submitted).
+    """
+    amplicon_alnfiles = []
+    clines = []
+    mafft_alnfiles = []  # alignments that MAFFT will write
+    pairfiles = []  # (input, output) paths for in-process pair alignments
+
+    def queue_commands():
+        """Record alignment files and yield MAFFT commands as they compile"""
+        for pname, alnoutfname, cline, pairfname in compile_mafft_commands(
+            args, logger, amplicon_fasta, outdir
+        ):
+            amplicon_alnfiles.append((pname, alnoutfname))
+            if pairfname is not None:
+                pairfiles.append((pairfname, alnoutfname))
+            if cline is not None:
+                clines.append(cline)
+                mafft_alnfiles.append(alnoutfname)
+                yield cline
+
     # Pass command-lines to the appropriate scheduler
+    if args.scheduler == "multiprocessing":
+        logger.info("Aligning amplicons with MAFFT as they are extracted")
+        run_parallel_jobs(queue_commands(), args, logger, workers)
+    elif args.scheduler == "SGE":  # submit as array jobs, one task per file
+        if list(queue_commands()):
+            logger.info("Aligning amplicons with MAFFT (SGE array jobs)")
+            jobgroups = mafft_sge_jobgroups(args, mafft_alnfiles)
+            sge.build_and_submit_jobs(os.curdir, jobgroups, args.sgeargs)
+            # Local CPUs are free while the cluster runs MAFFT
+            align_amplicon_pairs(args, logger, pairfiles)
+            pairfiles.clear()
+            logger.info("Waiting for SGE-submitted jobs to finish (polling)")
+            for jobgroup in jobgroups:
+                jobgroup.wait()
+    else:  # other schedulers need the complete set of commands up front
+        commands = list(queue_commands())
+        if commands:
+            logger.info("Aligning amplicons with MAFFT")
+            run_parallel_jobs(commands, args, logger)
+    # Pair alignments wait for the local MAFFT pool, to stay within --workers
+    align_amplicon_pairs(args, logger, pairfiles)
     if clines:
-        logger.info("Aligning amplicons with MAFFT")
-        logger.info("MAFFT command lines:\n\t%s", "\n\t".join(clines))
-        pretty_clines = [str(c).replace(" -", " \\\n          -") for c in clines]
-        log_clines(pretty_clines, logger)
-        run_parallel_jobs(clines, args, logger)
+        # Only build the (potentially large) pretty-printed command listing
+        # if it will actually be logged
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("MAFFT command lines:\n\t%s", "\n\t".join(clines))
+            log_clines([c.replace(" -", " \\\n          -") for c in clines], logger)
     else:
         logger.warning(
             "No MAFFT jobs were scheduled (you may see this if the --recovery option is active)"
@@ -167,6 +343,8 @@ def subcmd_extract(args, logger, use_parallelism=True):
         if set to True, use joblib to parallelise tasks; set to False to aid
         with debugging/localising issues
     """
+    from joblib import Parallel, delayed, dump
+
     logger.info("Extracting amplicons for primer set %s", args.primerfile)
     logger.info("PrimerSearch and genome information provided by %s", args.infilename)
     if not args.noalign:
@@ -185,43 +363,92 @@ def subcmd_extract(args, logger, use_parallelism=True):
     coll = load_config_json(args, logger)
 
     # Run parallel extractions of primers
+    # The PDPCollection is written to a temporary file once, and each worker
+    # process loads it from there on first use, rather than receiving a
+    # pickled copy with every batch of tasks. The file must persist until the
+    # (lazily-evaluated) extraction results have all been consumed.
     logger.info("Extracting amplicons from source genomes")
-    if use_parallelism:
-        results = Parallel(n_jobs=multiprocessing.cpu_count())(
-            delayed(extract_primers)(
-                task_name,
-                primer,
-                coll,
-                outdir,
-                (args.ex_minamplicon, args.ex_maxamplicon),
+    with tempfile.TemporaryDirectory() as tmpdir:
+        collpath = os.path.join(tmpdir, "collection.pkl")
+        dump(coll, collpath)
+        cpus = args.workers or CPU_COUNT
+        mafft_workers = None
+        if use_parallelism:
+            # With the multiprocessing scheduler, MAFFT jobs run while
+            # extraction continues, so the two share a single CPU budget
+            if not args.noalign and args.scheduler == "multiprocessing":
+                n_jobs = extraction_worker_count(coll, len(primers), max(1, cpus // 2))
+                mafft_workers = max(1, cpus - n_jobs)
+            else:
+                n_jobs = extraction_worker_count(coll, len(primers), cpus)
+            logger.info("Extracting amplicons with %d workers", n_jobs)
+            # Tasks are dispatched in batches of roughly a quarter of each
+            # worker's share, to limit dispatch overhead
+            batch_size = max(1, len(primers) // (4 * n_jobs))
+            # Results are returned lazily, as each batch completes, so that
+            # downstream MAFFT alignment can begin before extraction has finished
+            results = Parallel(
+                n_jobs=n_jobs,
+                backend="loky",
+                batch_size=batch_size,
+                return_as="generator_unordered",
+            )(
+                delayed(extract_primers)(
+                    task_name,
+                    primer,
+                    collpath,
+                    outdir,
+                    (args.ex_minamplicon, args.ex_maxamplicon),
+                )
+                for primer in tqdm(
+                    primers, desc="extracting amplicons", disable=args.disable_tqdm
+                )
             )
+        else:
+            results = []
             for primer in tqdm(
                 primers, desc="extracting amplicons", disable=args.disable_tqdm
+            ):
+                result = extract_primers(
+                    task_name,
+                    primer,
+                    collpath,
+                    outdir,
+                    (args.ex_minamplicon, args.ex_maxamplicon),
+                )
+                results.append(result)
+        amplicon_seqfiles = itertools.chain.from_iterable(results)
+
+        # Align the sequences with MAFFT
+        if not args.noalign:
+            amplicon_seqfiles = mafft_align_sequences(
+                args, logger, amplicon_seqfiles, outdir, mafft_workers
             )
+        else:
+            amplicon_seqfiles = [
+                (pname, fname) for pname, fname, _ in amplicon_seqfiles
+            ]
+
+    # Calculate distance matrix information for each alignment
+    # Note: ordered output for the table; tqdm call returns
+    # (primer filename, alignment filename)
+    logger.info("Calculating distance matrices")
+    alignments = tqdm(
+        sorted(amplicon_seqfiles),
+        desc="processing alignments",
+        disable=args.disable_tqdm,
+    )
+    if use_parallelism:
+        distresults = Parallel(n_jobs=CPU_COUNT)(
+            delayed(summarise_alignment)(pname, alnfname)
+            for pname, alnfname in alignments
         )
     else:
-        results = []
-        for primer in tqdm(
-            primers, desc="extracting amplicons", disable=args.disable_tqdm
-        ):
-            result = extract_primers(
-                task_name,
-                primer,
-                coll,
-                outdir,
-                (args.ex_minamplicon, args.ex_maxamplicon),
-            )
-            results.append(result)
-    amplicon_seqfiles = dict(pair for d in results for pair in d.items())
-
-    # Align the sequences with MAFFT
-    if not args.noalign:
-        amplicon_seqfiles = mafft_align_sequences(
-            args, logger, amplicon_seqfiles, outdir
-        )
+        distresults = [
+            summarise_alignment(pname, alnfname) for pname, alnfname in alignments
+        ]
 
-    # Calculate distance matrix information and write to file
-    logger.info("Calculating distance matrices")
+    # Write distance matrix information to file
     distoutfname = os.path.join(outdir, "distances_summary.tab")
     logger.info("Writing distance metric summaries to %s", distoutfname)
     with open(distoutfname, "w") as ofh:
@@ -241,35 +468,19 @@ def subcmd_extract(args, logger, use_parallelism=True):
             )
             + "\n"
         )
-        # Note: ordered output for the table; tqdm call returns
-        # (primer filename, alignment filename)
-        for fnames in tqdm(
-            sorted(amplicon_seqfiles.items()),
-            desc="processing alignments",
-            disable=args.disable_tqdm,
-        ):
-            try:
-                result = extract.calculate_distance(
-                    AlignIO.read(open(fnames[1]), "fasta")
-                )
-            except PDPAmpliconError as exc:  # Catches alignment/calculation problems
+        # Rows are buffered and written in batches to reduce write calls
+        rows = []
+        for pname, result, exc in distresults:
+            if exc is not None:
                 logger.warning("Distance calculation error: %s", exc)
-                result = extract.DistanceResults(None, [], 0, 0, 0, 0, 0, 0, 0, 0)
-            ofh.write(
-                "\t".join(
-                    [
-                        fnames[0],
-                        "%0.4f" % result.mean,
-                        "%0.4f" % result.sd,
-                        "%0.4f" % result.min,
-                        "%0.4f" % result.max,
-                        "%d" % result.unique,
-                        "%d" % result.nonunique,
-                        "%.02f" % result.shannon,
-                        "%.02f" % result.evenness,
-                    ]
-                )
-                + "\n"
+            rows.append(
+                f"{pname}\t{result.mean:.4f}\t{result.sd:.4f}\t{result.min:.4f}\t"
+                f"{result.max:.4f}\t{result.unique:d}\t{result.nonunique:d}\t"
+                f"{result.shannon:.2f}\t{result.evenness:.2f}\n"
             )
+            if len(rows) >= TSV_BATCH_SIZE:
+                ofh.writelines(rows)
+                rows.clear()
+        ofh.writelines(rows)
 
     return 0
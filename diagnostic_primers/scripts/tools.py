@@ -110,12 +110,16 @@ def log_clines(clines, logger):
 
 
 # Pass jobs to the appropriate scheduler
-def run_parallel_jobs(clines, args, logger):
-    """Run the passed command-lines in parallel."""
+def run_parallel_jobs(clines, args, logger, workers=None):
+    """Run the passed command-lines in parallel.
+
+    If workers is given, it overrides args.workers as the number of jobs
+    run at once by the multiprocessing scheduler.
+    """
     logger.info("Running jobs using scheduler: %s" % args.scheduler)
     # Pass lines to scheduler and run
     if args.scheduler == "multiprocessing":
-        retvals = multiprocessing.run(clines, workers=args.workers)
+        retvals = multiprocessing.run(clines, workers=workers or args.workers)
         if retvals != 0:
             logger.error("At least one run has problems (exiting).")
             raise SystemExit(1)
@@ -53,7 +53,7 @@ import subprocess
 
 from collections import defaultdict
 
-from diagnostic_primers.sge_jobs import JobGroup
+from diagnostic_primers.sge_jobs import QSTAT_CACHE, JobGroup
 
 QSUB_DEFAULT = "qsub"
 
@@ -257,34 +257,30 @@ def submit_safe_jobs(root_dir, jobs, sgeargs=None):
 
         # Add job name, current working directory, SGE stdout and stderr
         # directories to the SGE command line
-        args = " -N %s " % (job.name)
-        args += " -cwd "
-        args += " -o %s -e %s " % (job.out, job.err)
+        args = ["-N", job.name, "-cwd", "-o", job.out, "-e", job.err]
 
         # If a queue is specified, add this to the SGE command line
         # if job.queue is not None and job.queue in local_queues:
         #    args += local_queues[job.queue]
-        #    #args += "-q %s " % job.queue
+        #    #args += ["-q", job.queue]
 
         # If the job is actually a JobGroup, add the task numbering argument
         if isinstance(job, JobGroup):
-            args += "-t 1:%d " % (job.tasks)
+            args += ["-t", "1:%d" % (job.tasks)]
 
         # If there are dependencies for this job, hold the job until they are
         # complete
         if job.dependencies:
-            args += "-hold_jid "
-            for dep in job.dependencies:
-                args += dep.name + ","
-            args = args[:-1]
+            args += ["-hold_jid", ",".join([dep.name for dep in job.dependencies])]
 
-        # Build the qsub SGE commandline (passing local environment)
-        qsubcmd = "%s -V %s %s" % (QSUB_DEFAULT, args, job.scriptPath)
+        # Build the qsub SGE commandline (passing local environment), as an
+        # argument list so that no shell quoting is needed
+        args = [QSUB_DEFAULT, "-V"] + args + [job.scriptPath]
         if sgeargs is not None:
-            qsubcmd = "%s %s" % (qsubcmd, sgeargs)
-        args = [shlex.quote(_) for _ in qsubcmd.split()]
+            args += shlex.split(sgeargs)
         subprocess.run(args)  # nosec
         job.submitted = True  # Set the job's submitted flag to True
+        QSTAT_CACHE.invalidate()  # Earlier qstat output won't list this job
 
 
 def submit_jobs(root_dir, jobs, sgeargs=None):
@@ -64,16 +64,76 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import shlex
+import getpass
 import subprocess
+import threading
 import time
 
+from xml.etree import ElementTree
+
 SGE_WAIT = 0.01  # Initial polling wait time in s
 
 ###
 # CLASSES
 
 
+# The QstatCache class holds a single snapshot of the scheduler's job list,
+# so that many waiting jobs can share one qstat call per polling interval.
+class QstatCache(object):
+
+    """Shared, periodically refreshed record of job names known to SGE."""
+
+    def __init__(self):
+        """Instantiates an empty QstatCache object."""
+        self.pending = set()  # Names of jobs queued or running at last poll
+        self.last_time = None  # time.monotonic() of last poll, None if invalid
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        """Discard the current snapshot, e.g. when new jobs are submitted."""
+        with self.lock:
+            self.last_time = None
+
+    def refresh_if_stale(self, interval=SGE_WAIT):
+        """Poll qstat if the snapshot is older than the passed interval.
+
+        - interval       Maximum age of the snapshot, in seconds
+
+        A single `qstat -xml` call lists every job for the current user. If
+        qstat fails, no jobs are recorded as pending.
+        """
+        with self.lock:
+            if (
+                self.last_time is not None
+                and time.monotonic() - self.last_time < interval
+            ):
+                return
+            result = subprocess.run(
+                ["qstat", "-xml", "-u", getpass.getuser()],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )  # nosec
+            try:
+                root = ElementTree.fromstring(result.stdout)
+                self.pending = {_.text for _ in root.iter("JB_name")}
+            except ElementTree.ParseError:
+                self.pending = set()
+            self.last_time = time.monotonic()
+
+    def is_pending(self, name, interval=SGE_WAIT):
+        """Return True if the named job is queued or running under SGE.
+
+        - name           String, the job name
+        - interval       Maximum age of the qstat snapshot used, in seconds
+        """
+        self.refresh_if_stale(interval)
+        return name in self.pending
+
+
+# Module-level cache shared by all Jobs and JobGroups
+QSTAT_CACHE = QstatCache()
+
+
 # The Job class describes a single command-line job, with dependencies (jobs
 # that must be run first.
 class Job(object):
@@ -117,11 +177,10 @@ class Job(object):
         finished = False
         while not finished:
             time.sleep(interval)
+            # Accept a qstat snapshot taken during the sleep just finished,
+            # before backing off the polling interval
+            finished = not QSTAT_CACHE.is_pending(self.name, interval)
             interval = min(2 * interval, 60)
-            cmd = "qstat -j {}".format(self.name)
-            args = [shlex.quote(_) for _ in cmd.split()]
-            result = subprocess.run(args, stdout=subprocess.DEVNULL)  # nosec
-            finished = result.returncode  # 1 if job does not exist
 
 
 class JobGroup(object):
@@ -216,8 +275,7 @@ class JobGroup(object):
         finished = False
         while not finished:
             time.sleep(interval)
+            # Accept a qstat snapshot taken during the sleep just finished,
+            # before backing off the polling interval
+            finished = not QSTAT_CACHE.is_pending(self.name, interval)
             interval = min(2 * interval, 60)
-            cmd = "qstat -j {}".format(self.name)
-            args = [shlex.quote(_) for _ in cmd.split()]
-            result = subprocess.run(args, stdout=subprocess.DEVNULL)  # nosec
-            finished = result.returncode  # 1 if job does not exist
@@ -69,8 +69,8 @@ with open("diagnostic_primers/__init__.py") as fh:
             version = m.group("version")
             break
 
-if sys.version_info <= (3, 0):
-    sys.stderr.write("ERROR: diagnostic_primers requires Python3 (exiting)\n")
+if sys.version_info < (3, 8):
+    sys.stderr.write("ERROR: diagnostic_primers requires Python 3.8+ (exiting)\n")
     sys.exit(1)
 
 setuptools.setup(
@@ -96,12 +96,22 @@ setuptools.setup(
         os.path.join("bin", "pdp_mafft_wrapper.py"),
         os.path.join("bin", "delta_filter_wrapper.py"),
     ],
+    python_requires=">=3.8",
     packages=[
         "diagnostic_primers",
         "diagnostic_primers/scripts",
         "diagnostic_primers/scripts/subcommands",
     ],
-    install_requires=["biopython", "pandas", "plotly", "joblib", "tqdm", "pybedtools"],
+    install_requires=[
+        "biopython",
+        "numpy",
+        "pandas",
+        "plotly",
+        "psutil",
+        "joblib>=1.4",
+        "tqdm",
+        "pybedtools",
+    ],
     package_data={},
     classifiers=[
         "Development Status :: 5 - Production/Stable",
@@ -111,7 +121,8 @@ setuptools.setup(
         "Operating System :: MacOS :: MacOS X",
         "Operating System :: POSIX :: Linux",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
         "Topic :: Scientific/Engineering :: Bio-Informatics",
     ],
 )
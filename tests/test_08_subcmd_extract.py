@@ -61,13 +61,20 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import importlib
+import json
 import logging
 import os
 import shutil
+import subprocess
 
 from argparse import Namespace
 from collections import namedtuple
+from unittest import mock
 
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+from diagnostic_primers import extract
 from diagnostic_primers.scripts import subcommands
 
 from tools import PDPTestCase, modify_namespace
@@ -76,6 +83,12 @@ from tools import PDPTestCase, modify_namespace
 # setUpClass() classmethod.
 OUTDIR = os.path.join("tests", "test_output", "pdp_extract")
 
+# The subcommands package exports the subcmd_extract() function under the
+# same name as its module, so the module is imported explicitly
+subcmd_extract = importlib.import_module(
+    "diagnostic_primers.scripts.subcommands.subcmd_extract"
+)
+
 # Convenience struct to describe scheduler settings
 Scheduling = namedtuple("Scheduling", "scheduler workers")
 
@@ -264,3 +277,174 @@ class TestExtractSubcommand(PDPTestCase):
             os.path.join(self.iopaths.outdir, "prodigaligr", "align", self.filestem),
             os.path.join(self.iopaths.targetdir, "prodigaligr", "align", self.filestem),
         )
+
+    def test_extract_prodigal_pairs(self):
+        """Extract command aligns two-sequence amplicons without MAFFT.
+
+        Restricting the run to two genomes gives amplicon files with exactly
+        two sequences. These are aligned in-process, so MAFFT is given a path
+        that does not exist, and would fail if it were called.
+        """
+        outdir = os.path.join(self.iopaths.outdir, "prodigal", "pairs")
+        os.makedirs(outdir, exist_ok=True)
+        with open(os.path.join(self.iopaths.indir, "primersearch_prod.json")) as ifh:
+            config = json.load(ifh)[:2]
+        names = [_["name"] for _ in config]
+        for entry in config:
+            with open(entry["primersearch"]) as ifh:
+                psdata = json.load(ifh)
+            entry["primersearch"] = os.path.join(
+                outdir, os.path.split(entry["primersearch"])[-1]
+            )
+            with open(entry["primersearch"], "w") as ofh:
+                json.dump(
+                    {
+                        key: val
+                        for key, val in psdata.items()
+                        if key in names + ["primers", "query"]
+                    },
+                    ofh,
+                )
+        configfname = os.path.join(outdir, "primersearch_pairs.json")
+        with open(configfname, "w") as ofh:
+            json.dump(config, ofh)
+
+        subcommands.subcmd_extract(
+            modify_namespace(
+                self.base_namespace,
+                {
+                    "infilename": configfname,
+                    "primerfile": os.path.join(
+                        self.iopaths.classifydir, "prodigal", "gv1_primers.json"
+                    ),
+                    "outdir": outdir,
+                    "mafft_exe": os.path.join(outdir, "no_mafft"),
+                },
+            ),
+            self.logger,
+        )
+
+        # Check each two-sequence amplicon file has a gapped, lower-case
+        # alignment of the same sequences, with the same headers
+        pairs = 0
+        ampdir = os.path.join(outdir, "gv1_primers")
+        for fname in os.listdir(ampdir):
+            if os.path.splitext(fname)[-1] != ".fasta":
+                continue
+            with open(os.path.join(ampdir, fname)) as ifh:
+                records = list(SimpleFastaParser(ifh))
+            if len(records) != 2:
+                continue
+            pairs += 1
+            alnfname = os.path.join(ampdir, os.path.splitext(fname)[0] + ".aln")
+            with open(alnfname) as ifh:
+                aligned = list(SimpleFastaParser(ifh))
+            self.assertEqual(
+                [(title, row.replace("-", "")) for title, row in aligned],
+                [(title, seq.lower()) for title, seq in records],
+            )
+            self.assertEqual(len(aligned[0][1]), len(aligned[1][1]))
+        self.assertGreater(pairs, 0)
+
+
+class TestExtractMAFFTJobs(PDPTestCase):
+    """Class defining tests of MAFFT job scheduling for pdp.py extract."""
+
+    def setUp(self):
+        """Set parameters for tests."""
+        self.outdir = os.path.join(OUTDIR, "mafft_jobs")
+        os.makedirs(self.outdir, exist_ok=True)
+
+        # null logger
+        self.logger = logging.getLogger("TestExtractMAFFTJobs logger")
+        self.logger.addHandler(logging.NullHandler())
+
+        self.args = Namespace(
+            mafft_exe="mafft",
+            scheduler="SGE",
+            workers=1,
+            sgegroupsize=2,
+            sgeargs="-q all.q",
+            jobprefix="pdptest",
+            disable_tqdm=True,
+            recovery=False,
+        )
+        # Stems include shell metacharacters and whitespace
+        self.stems = [
+            os.path.join(self.outdir, _)
+            for _ in ("primer_00001", "primer $2", "primer's 3")
+        ]
+
+    def test_mafft_sge_jobgroups(self):
+        """extract builds SGE array jobs that pass each file stem unchanged."""
+        jobgroups = subcmd_extract.mafft_sge_jobgroups(
+            self.args, [_ + ".aln" for _ in self.stems]
+        )
+        self.assertEqual(
+            [(_.name, _.tasks) for _ in jobgroups],
+            [("pdptest_mafft_1", 2), ("pdptest_mafft_2", 1)],
+        )
+        stems = []
+        for jobgroup in jobgroups:
+            self.assertTrue(
+                jobgroup.script.endswith(
+                    'pdp_mafft_wrapper.py mafft --quiet "$stem.fasta" "$stem.aln"\n'
+                )
+            )
+            # Run each array task, printing the stem in place of calling MAFFT
+            script = jobgroup.script.replace(jobgroup.command, 'printf %s "$stem"')
+            for task in range(1, jobgroup.tasks + 1):
+                stems.append(
+                    subprocess.run(
+                        ["bash", "-c", script],
+                        env={"SGE_TASK_ID": str(task)},
+                        stdout=subprocess.PIPE,
+                        check=True,
+                        universal_newlines=True,
+                    ).stdout
+                )
+        self.assertEqual(stems, self.stems)
+
+    def test_mafft_align_sequences_sge(self):
+        """extract submits MAFFT jobs to SGE and aligns pairs locally."""
+        amplicon_fasta = []
+        for stem in self.stems:
+            with open(stem + ".fasta", "w") as ofh:
+                ofh.write(">a\nACGTACGT\n>b\nACGTACGA\n>c\nACGTACCT\n")
+            amplicon_fasta.append((os.path.basename(stem), stem + ".fasta", 3))
+        # Two-sequence files are aligned locally while SGE runs MAFFT
+        pairstem = os.path.join(self.outdir, "primer_pair")
+        with open(pairstem + ".fasta", "w") as ofh:
+            ofh.write(">a\nACGTACGTACGGATTACAGGT\n>b\nACGTACGTCGGATTACAGGT\n")
+        amplicon_fasta.append(("primer_pair", pairstem + ".fasta", 2))
+
+        with mock.patch(
+            "diagnostic_primers.sge.build_and_submit_jobs"
+        ) as submit, mock.patch(
+            "diagnostic_primers.sge_jobs.JobGroup.wait"
+        ) as wait, mock.patch(
+            "diagnostic_primers.extract.align_amplicon_pair",
+            wraps=extract.align_amplicon_pair,
+        ) as align_pair:
+            alnfiles = subcmd_extract.mafft_align_sequences(
+                self.args, self.logger, amplicon_fasta, self.outdir
+            )
+
+        self.assertEqual(
+            alnfiles,
+            [(os.path.basename(_), _ + ".aln") for _ in self.stems + [pairstem]],
+        )
+        align_pair.assert_called_once_with(pairstem + ".fasta", pairstem + ".aln")
+        with open(pairstem + ".aln") as ifh:
+            self.assertEqual(
+                [row for _, row in SimpleFastaParser(ifh)],
+                ["acgtacgtacggattacaggt", "acgtacgt-cggattacaggt"],
+            )
+        submit.assert_called_once()
+        rootdir, jobgroups, sgeargs = submit.call_args[0]
+        self.assertEqual((rootdir, sgeargs), (os.curdir, "-q all.q"))
+        self.assertEqual(
+            [(_.name, _.tasks) for _ in jobgroups],
+            [("pdptest_mafft_1", 2), ("pdptest_mafft_2", 1)],
+        )
+        self.assertEqual(wait.call_count, len(jobgroups))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""test_extract.py
+
+Test loading of amplicon alignments, and calculation of distance summaries.
+
+This test suite is intended to be run from the repository root using:
+
+pytest -v
+
+(c) The James Hutton Institute 2017-2019
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD2 5DA,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017-2019 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import shutil
+
+from collections import namedtuple
+
+import pytest
+
+from Bio import AlignIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+from diagnostic_primers import extract
+from tools import PDPTestCase
+
+# Defined as global so it can be seen by the TestDistances() class
+# setUpClass() classmethod.
+OUTDIR = os.path.join("tests", "test_output", "extract")
+
+# Convenience struct for expected distance summary values
+DistSummary = namedtuple("DistSummary", "mean sd min max unique nonunique")
+
+
+class TestDistances(PDPTestCase):
+    """Class defining tests of amplicon alignment distance calculations."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Clean up old output directory
+        if os.path.isdir(OUTDIR):
+            shutil.rmtree(OUTDIR)
+        os.makedirs(OUTDIR)
+
+    def setUp(self):
+        """Set parameters for tests."""
+        self.alndir = os.path.join(
+            "tests",
+            "test_targets",
+            "pdp_extract",
+            "prodigal",
+            "align",
+            "Pectobacterium_primers",
+        )
+        self.alnfile = os.path.join(self.alndir, "GCF_000260925.1_primer_00008.aln")
+        self.target = DistSummary(0.0443, 0.0239, 0.0, 0.07, 5, 3)
+
+    def test_load_alignment_array(self):
+        """extract loads FASTA alignment as one uint8 row per sequence."""
+        aln = extract.load_alignment_array(self.alnfile)
+        self.assertEqual(aln.shape, (8, 100))
+        self.assertEqual(aln.dtype.name, "uint8")
+
+    def test_calculate_distance(self):
+        """extract calculates identity distance summary for alignment."""
+        result = extract.calculate_distance(extract.load_alignment_array(self.alnfile))
+        self.assertEqual(len(result.distances), 8 * 7 // 2)
+        self.assertEqual(
+            DistSummary(
+                round(result.mean, 4),
+                round(result.sd, 4),
+                round(result.min, 4),
+                round(result.max, 4),
+                result.unique,
+                result.nonunique,
+            ),
+            self.target,
+        )
+
+    def test_calculate_distance_shannon(self):
+        """extract reports same Shannon index as shannon_index()."""
+        aln = extract.load_alignment_array(self.alnfile)
+        result = extract.calculate_distance(aln)
+        self.assertEqual((result.shannon, result.evenness), extract.shannon_index(aln))
+
+    def test_calculate_distance_identical(self):
+        """extract reports zero Shannon evenness for identical sequences."""
+        aln = extract.load_alignment_array(self.alnfile)[[0, 0]]
+        result = extract.calculate_distance(aln)
+        self.assertEqual((result.unique, result.evenness), (1, 0))
+
+    def test_calculate_distance_alignio(self):
+        """extract calculates same distances for MultipleSeqAlignment input."""
+        result = extract.calculate_distance(AlignIO.read(self.alnfile, "fasta"))
+        target = extract.calculate_distance(extract.load_alignment_array(self.alnfile))
+        self.assertEqual(result[1:], target[1:])
+
+    def test_calculate_distance_single(self):
+        """extract raises error for distances of single-sequence alignment."""
+        aln = extract.load_alignment_array(self.alnfile)[:1]
+        with pytest.raises(extract.PDPAmpliconError):
+            extract.calculate_distance(aln)
+
+    def test_align_amplicon_pair(self):
+        """extract aligns two-sequence amplicon file without MAFFT."""
+        with open(self.alnfile, "r") as ifh:
+            records = list(SimpleFastaParser(ifh))[:2]
+        pairfname = os.path.join(OUTDIR, "amplicon_pair.fasta")
+        with open(pairfname, "w") as ofh:
+            for title, seq in records:
+                ofh.write(">%s\n%s\n" % (title, seq.upper()))
+        alnfname = os.path.join(OUTDIR, "amplicon_pair.aln")
+        extract.align_amplicon_pair(pairfname, alnfname)
+        self.assertTrue(
+            (
+                extract.load_alignment_array(alnfname)
+                == extract.load_alignment_array(self.alnfile)[:2]
+            ).all()
+        )
+
+    def test_align_amplicon_pair_indel(self):
+        """extract gaps internal indels and unequal ends in amplicon pairs."""
+        pairs = (
+            (
+                (
+                    ("amp_1 Predicted diagnostic amplicon", "ACGTACGTACGGATTACAGGT"),
+                    ("amp_2 Predicted diagnostic amplicon", "ACGTACGTCGGATTACAGGT"),
+                ),
+                ("acgtacgtacggattacaggt", "acgtacgt-cggattacaggt"),
+            ),
+            (
+                (
+                    ("amp_3 Predicted diagnostic amplicon", "ACGTACGTACGGATTACAGGT"),
+                    ("amp_4 Predicted diagnostic amplicon", "GGACGTACGTCGGATTACAGG"),
+                ),
+                ("--acgtacgtacggattacaggt", "ggacgtacgt-cggattacagg-"),
+            ),
+        )
+        for idx, (records, rows) in enumerate(pairs):
+            pairfname = os.path.join(OUTDIR, "amplicon_indel_%d.fasta" % idx)
+            with open(pairfname, "w") as ofh:
+                for title, seq in records:
+                    ofh.write(">%s\n%s\n" % (title, seq))
+            alnfname = os.path.join(OUTDIR, "amplicon_indel_%d.aln" % idx)
+            extract.align_amplicon_pair(pairfname, alnfname)
+            with open(alnfname, "r") as ifh:
+                aligned = list(SimpleFastaParser(ifh))
+            self.assertEqual(
+                aligned, [(title, row) for (title, _), row in zip(records, rows)]
+            )
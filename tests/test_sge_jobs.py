@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""test_sge_jobs.py
+
+Test polling of SGE job status through the shared qstat cache.
+
+This test suite is intended to be run from the repository root using:
+
+pytest -v
+
+(c) The James Hutton Institute 2017-2019
+Author: Leighton Pritchard
+
+Contact:
+leighton.pritchard@hutton.ac.uk
+
+Leighton Pritchard,
+Information and Computing Sciences,
+James Hutton Institute,
+Errol Road,
+Invergowrie,
+Dundee,
+DD2 5DA,
+Scotland,
+UK
+
+The MIT License
+
+Copyright (c) 2017-2019 The James Hutton Institute
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import subprocess
+import unittest
+
+from unittest import mock
+
+from diagnostic_primers import sge, sge_jobs
+
+
+class FakeClock:
+    """Stand-in for the time module, advanced only by sleep() calls."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeQstat:
+    """Stand-in for subprocess.run, returning qstat -xml job lists in turn.
+
+    The last job list is repeated once the others are used up.
+    """
+
+    def __init__(self, snapshots):
+        self.snapshots = list(snapshots)
+        self.calls = []
+
+    def __call__(self, args, **kwargs):
+        self.calls.append(args)
+        names = self.snapshots.pop(0) if len(self.snapshots) > 1 else self.snapshots[0]
+        jobs = "".join(
+            ["<job_list><JB_name>%s</JB_name></job_list>" % _ for _ in names]
+        )
+        return subprocess.CompletedProcess(
+            args,
+            0,
+            stdout=("<job_info><queue_info>%s</queue_info></job_info>" % jobs).encode(),
+        )
+
+    @property
+    def qstat_calls(self):
+        """Number of calls that were qstat polls"""
+        return len([_ for _ in self.calls if _[0] == "qstat"])
+
+
+class TestQstatCache(unittest.TestCase):
+    """Class defining tests of SGE job polling."""
+
+    def setUp(self):
+        """Give each test a fresh cache and clock."""
+        self.cache = sge_jobs.QstatCache()
+        self.clock = FakeClock()
+        self.patches = [
+            mock.patch.object(sge_jobs, "QSTAT_CACHE", self.cache),
+            mock.patch.object(sge, "QSTAT_CACHE", self.cache),
+            mock.patch.object(sge_jobs, "time", self.clock),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def test_wait_job_finishes(self):
+        """Job.wait() returns as soon as the job leaves the qstat snapshot."""
+        qstat = FakeQstat([{"job1"}, set()])
+        with mock.patch.object(subprocess, "run", qstat):
+            sge_jobs.Job("job1", "true").wait()
+        self.assertEqual(qstat.qstat_calls, 2)
+        self.assertLess(self.clock.now, 1)
+
+    def test_wait_jobgroup_finishes(self):
+        """JobGroup.wait() returns as soon as the group leaves the snapshot."""
+        qstat = FakeQstat([{"jg1"}, {"jg1"}, set()])
+        with mock.patch.object(subprocess, "run", qstat):
+            sge_jobs.JobGroup("jg1", "true").wait()
+        self.assertEqual(qstat.qstat_calls, 3)
+        self.assertLess(self.clock.now, 1)
+
+    def test_snapshot_reused(self):
+        """QstatCache reuses a snapshot younger than the requested age."""
+        qstat = FakeQstat([{"job1"}])
+        with mock.patch.object(subprocess, "run", qstat):
+            self.assertTrue(self.cache.is_pending("job1", 60))
+            self.assertFalse(self.cache.is_pending("job2", 60))
+        self.assertEqual(qstat.qstat_calls, 1)
+
+    def test_invalidate(self):
+        """QstatCache polls qstat again after invalidate()."""
+        qstat = FakeQstat([set(), {"job1"}])
+        with mock.patch.object(subprocess, "run", qstat):
+            self.assertFalse(self.cache.is_pending("job1", 60))
+            self.cache.invalidate()
+            self.assertTrue(self.cache.is_pending("job1", 60))
+        self.assertEqual(qstat.qstat_calls, 2)
+
+    def test_submit_invalidates(self):
+        """Submitting a job with qsub invalidates the qstat snapshot."""
+        job = sge_jobs.Job("job1", "true")
+        job.scriptPath = "job1.sh"
+        qstat = FakeQstat([set()])
+        with mock.patch.object(subprocess, "run", qstat):
+            self.cache.refresh_if_stale(60)
+            sge.submit_safe_jobs("sge_root", [job])
+        self.assertEqual(qstat.calls[-1][0], sge.QSUB_DEFAULT)
+        self.assertIsNone(self.cache.last_time)